@@ -1,164 +1,305 @@
+#!/usr/bin/env python3
 import mpd
-import gaugette.rotary_encoder
-import gaugette.switch
 import gaugette.rgbled
+import RPi.GPIO as GPIO
+# libgpiod 1.x bindings (1.5 or newer for the pull-up bias), not the incompatible 2.x ones
+import gpiod
 import threading
 import time
-import math
+import select
+import queue
+import collections
 import sys
+import os
+import socket
+import logging
+import enum
+import signal
 
-# Pins used by the rotary encoder
-ROT_A_PIN = 5
-ROT_B_PIN = 4
+# Address of the MPD server
+MPD_HOST = "localhost"
+MPD_PORT = 6600
 
-# Pin used by the push button
-BUTTON_PIN = 8
+# Time to wait before connecting to MPD again after losing the connection (in s)
+MPD_RECONNECT_DELAY = 5
 
-# Pins used by the LEDs
+# GPIO character device the rotary encoder is read from
+GPIO_CHIP = "gpiochip0"
+
+# Real-time (SCHED_FIFO) priority and CPU core for the thread reading the rotary encoder,
+# see the README for the privileges needed
+ROT_PRIORITY = 10
+ROT_CPU = 3
+
+# Pins used by the rotary encoder (BCM numbering, which are the line offsets on the
+# GPIO chip, wiringPi pins 5 and 4)
+ROT_A_PIN = 24
+ROT_B_PIN = 23
+
+# Pin used by the push button (BCM numbering, wiringPi pin 8)
+BUTTON_PIN = 2
+
+# Pins used by the LEDs (wiringPi numbering, as used by gaugette)
 R_LED_PIN = 2
 G_LED_PIN = 0
 B_LED_PIN = 1
 
 # Colors (in red, green, blue) to use for the modes
-COLOR_VOLUME = [100,   0,   0]
-COLOR_TRACKS = [0,   100,   0]
-COLOR_OFF    = [0,     0,   0]
+COLOR_VOLUME = (100,   0,   0)
+COLOR_TRACKS = (0,   100,   0)
+COLOR_OFF    = (0,     0,   0)
+
+# Modes the radio can be in
+class Mode(enum.IntEnum):
+  VOLUME = 0
+  TRACKS = 1
+  OFF    = 2
+
+# Colors and LED function (fading in or setting at once) to use per mode
+MODE_LEDS = {
+  Mode.VOLUME: (COLOR_VOLUME, "fade"),
+  Mode.TRACKS: (COLOR_TRACKS, "fade"),
+  Mode.OFF:    (COLOR_OFF,    "set"),
+}
 
 # Initial volume in percent
 INITIAL_VOLUME = 80
 
-# Factor in percent to add to the volume for a delta of 1:
-VOLUME_FACTOR = 0.2
+# Delta needed to change the volume by one percent:
+VOLUME_STEPS = 5
 
 # Duration to interpret as a "long" button press (in ms)
 LONG_PRESS_DURATION = 1200
 
+# Number of rotator steps between two detents of the encoder:
+STEPS_PER_DETENT = 4
+
+# Direction of a rotator step, indexed by the previous and the current states of pins A and B:
+ENCODER_STATES = (0, -1, 1, 0, 1, 0, 0, -1, -1, 0, 0, 1, 0, 1, -1, 0)
+
+# Minimum time between two edges on the same rotary encoder pin (in ns)
+ROT_DEBOUNCE_TIME = 100000
+
+# Debounce time for the push button (in ms)
+BUTTON_BOUNCE_TIME = 20
+
+# Maximum number of volumes sent to MPD to remember until MPD reports them back:
+PENDING_VOLUMES_SIZE = 16
+
+# Maximum number of input events waiting to be handled:
+EVENT_QUEUE_SIZE = 64
+
 # Amount to turn the rotator before a track/station is changed:
 TRACK_ROTATION_THRESHOLD = 20
 
 # Set to True to enable some debug output:
 DEBUG = False
 
+log = logging.getLogger("piradio")
+
 class PiRadio:
   
+  # Handlers run for every detent, so keep their attribute lookups cheap:
+  __slots__ = ('mode', 'playback', '_setvol', '_next', '_prev', 'volume_steps', 'last_volume',
+               'pending_volumes', 'last_track_rotation', 'events', 'led', 'mode_leds')
+  
   def __init__(self):
   
-    # Mode distincts between 'VOLUME', 'TRACKS' and 'OFF'
-    self.mode = "VOLUME"
+    # Mode distincts between VOLUME, TRACKS and OFF
+    self.mode = Mode.VOLUME
+    
+    # MPD connection for playback, shared by the threads and reconnecting when MPD restarts
+    self.playback = MpdProxy(MPD_HOST, MPD_PORT)
     
-    # MPD client connection for playback
-    self.playback = mpd.MPDClient()
+    # Bound once, as they are called from the rotator handler:
+    self._setvol = self.playback.setvol
+    self._next = self.playback.next
+    self._prev = self.playback.previous
     
-    # Convenience and performance improvement: store the last volume
+    # Convenience and performance improvement: store the last volume sent to MPD
     self.last_volume = INITIAL_VOLUME
     
+    # Volumes sent to MPD that have not been reported back by the mixer yet:
+    self.pending_volumes = collections.deque(maxlen=PENDING_VOLUMES_SIZE)
+    
+    # Volume in steps of the rotator, finer grained than the percents MPD takes:
+    self.volume_steps = INITIAL_VOLUME * VOLUME_STEPS
+    
     # Remember a rotation value for changing the track:
     self.last_track_rotation = 0
     
+    # Input events waiting to be handled by the dispatch thread:
+    self.events = queue.Queue(EVENT_QUEUE_SIZE)
+    
     # Initialize and start the playback:
-    self.playback.timeout = 10
-    self.playback.idletimeout = None
-    self.playback.connect("localhost", 6600)
     self.playback.setvol(self.last_volume)
     self.playback.play()
     
-    # Start the thread that listens for changes to the rotary encoder:
-    rotator_thread = RotatorThread(self)
-    rotator_thread.start()
-    
-    # Start the thread that listens for button pushes:
-    button_thread = ButtonThread(self)
-    button_thread.start()
+    # Threads started so far: the dispatch thread, and the ones posting events to it
+    dispatch_thread = None
+    source_threads = []
     
-    # LED for indicating the mode
-    self.led = gaugette.rgbled.RgbLed(R_LED_PIN, G_LED_PIN, B_LED_PIN)
-    
-    self.adapt_led()
+    # Shut down on Ctrl-C as well as when being terminated, e.g. by the init system. The signals
+    # are blocked before any thread is started, so they stay pending until the main thread waits
+    # for them and cannot slip in before it does:
+    shutdown_signals = {signal.SIGINT, signal.SIGTERM}
+    old_signal_mask = signal.pthread_sigmask(signal.SIG_BLOCK, shutdown_signals)
     
     try:
-      while True:
-        time.sleep(10)
-    except KeyboardInterrupt:
-      if DEBUG:
-        print("Shutting down threads")
-      rotator_thread.stop()
-      button_thread.stop()
-      if DEBUG:
-        print("Threads shut down")
-    except:
-      rotator_thread.stop()
-      button_thread.stop()
-      raise
+      # Start the thread that handles the input events, so slow MPD commands never hold up the GPIO callbacks:
+      dispatch_thread = DispatchThread(self)
+      dispatch_thread.start()
+      
+      # Start the thread that listens for changes made to MPD, by us or by other clients:
+      idle_thread = MpdIdleThread(self)
+      idle_thread.start()
+      source_threads.append(idle_thread)
+      
+      # LED for indicating the mode
+      self.led = gaugette.rgbled.RgbLed(R_LED_PIN, G_LED_PIN, B_LED_PIN)
+      
+      # Colors and bound LED function per mode, indexed by the mode:
+      self.mode_leds = []
+      for mode in Mode:
+        colors, function = MODE_LEDS[mode]
+        self.mode_leds.append((colors, getattr(self.led, function)))
+      
+      self.adapt_led()
+      
+      # The push button is addressed by its BCM pin number:
+      GPIO.setmode(GPIO.BCM)
+      
+      # Start the thread that listens for changes to the rotary encoder:
+      rotator_thread = RotatorThread(self)
+      rotator_thread.start()
+      source_threads.append(rotator_thread)
+      
+      # Start the thread that listens for button pushes:
+      button_thread = ButtonThread(self)
+      button_thread.start()
+      source_threads.append(button_thread)
+      
+      # Park the main thread until a signal requests the shutdown:
+      signal.sigwait(shutdown_signals)
+    finally:
+      log.debug("Shutting down threads")
+      try:
+        # Stop the event sources before the thread handling their events, so it gets all of them:
+        self.stop_threads(source_threads)
+        if dispatch_thread is not None:
+          self.stop_threads([dispatch_thread])
+        GPIO.cleanup()
+        log.debug("Threads shut down")
+      finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_signal_mask)
+    
+  def stop_threads(self, threads):
+    # Stops and joins the threads, carrying on with the others should one of them fail:
+    stopped = []
+    for thread in threads:
+      try:
+        thread.stop()
+        stopped.append(thread)
+      except Exception:
+        log.exception("Failed to stop %s", type(thread).__name__)
+    # Threads that could not be told to stop might never finish, so don't wait for those:
+    for thread in stopped:
+      thread.join()
     
+  def post_event(self, kind, value=None):
+    # Called from the GPIO callbacks, so never block but rather drop the oldest event:
+    while True:
+      try:
+        self.events.put_nowait((kind, value))
+        return
+      except queue.Full:
+        try:
+          event = self.events.get_nowait()
+        except queue.Empty:
+          continue
+        if event is None:
+          # The dispatch thread is being stopped: keep its end marker, which it still has to
+          # get to, and drop the new event instead
+          self.events.put(None)
+          return
+
   def rotator_changed(self, delta):
     # Depending on the current mode, do something:
     
-    # If in "change volume" mode, add a certain factor of the delta to the volume:
-    if self.mode == "VOLUME":
-      self.last_volume += (delta * VOLUME_FACTOR)
+    # If in "change volume" mode, add the delta to the volume steps:
+    if self.mode is Mode.VOLUME:
+      steps = self.volume_steps + delta
       # Clamp the volume between 0 and 100:
-      self.last_volume = min(100, max(0, self.last_volume))
-      if DEBUG:
-        print("Volume: %3.1f" % self.last_volume)
-      self.playback.setvol(int(self.last_volume))
+      if steps < 0:
+        steps = 0
+      elif steps > 100 * VOLUME_STEPS:
+        steps = 100 * VOLUME_STEPS
+      self.volume_steps = steps
+      volume = steps // VOLUME_STEPS
+      log.debug("Volume: %d (%d steps)", volume, steps)
+      # MPD only knows whole percents, so only send a change in those:
+      if volume != self.last_volume:
+        self.last_volume = volume
+        self.pending_volumes.append(volume)
+        self._setvol(volume)
       
     # If in "change tracks" mode, count rotations until a change of track is reached:
-    elif self.mode == "TRACKS":
+    elif self.mode is Mode.TRACKS:
       self.last_track_rotation += delta
-      if DEBUG:
-        print("Last track rotation: %d" % self.last_track_rotation)
+      log.debug("Last track rotation: %d", self.last_track_rotation)
       if abs(self.last_track_rotation) > TRACK_ROTATION_THRESHOLD:
-        if math.copysign(1, self.last_track_rotation) < 0:
-          if DEBUG:
-            print("Going back to previous track")
-          self.playback.previous()
+        if self.last_track_rotation < 0:
+          log.debug("Going back to previous track")
+          self._prev()
         else:
-          if DEBUG:
-            print("Advancing to next track")
-          self.playback.next()
+          log.debug("Advancing to next track")
+          self._next()
         self.last_track_rotation = 0
 
   def button_released(self):
     # Depending on the current mode, react to the button release:
-    if DEBUG:
-      print("Button released")
-    if self.mode == "VOLUME":
-      self.mode = "TRACKS"
-      if DEBUG:
-        print("Mode changed to 'TRACKS'")
+    log.debug("Button released")
+    if self.mode is Mode.VOLUME:
+      self.mode = Mode.TRACKS
+      log.debug("Mode changed to 'TRACKS'")
     else:
-      self.mode = "VOLUME"
-      if DEBUG:
-        print("Mode changed to 'VOLUME'")
+      self.mode = Mode.VOLUME
+      log.debug("Mode changed to 'VOLUME'")
     self.adapt_led()
     
   def button_long_press(self):
     # Depending on the current mode, a long press on the button turns playback off or on:
-    if self.mode == "OFF":
-      if DEBUG:
-        print("Mode changed to 'VOLUME' (turning back on)")
-      self.mode = "VOLUME"
+    if self.mode is Mode.OFF:
+      log.debug("Mode changed to 'VOLUME' (turning back on)")
+      self.mode = Mode.VOLUME
       self.playback.play()
     else:
-      self.mode = "OFF"
-      if DEBUG:
-        print("Mode changed to 'OFF'")
+      self.mode = Mode.OFF
+      log.debug("Mode changed to 'OFF'")
       self.playback.stop()
     self.adapt_led()
     
+  def volume_changed(self, volume):
+    # Only take over volumes set by other clients, so the steps within our own are kept:
+    if volume < 0:
+      return
+    # Our own volumes may come back rounded by the mixer, or late while the rotator is spun:
+    for i, sent in enumerate(self.pending_volumes):
+      if abs(volume - sent) <= 1:
+        # Volumes sent before this one are not going to be reported anymore:
+        for _ in range(i + 1):
+          self.pending_volumes.popleft()
+        return
+    if volume == self.last_volume:
+      return
+    log.debug("Volume changed externally: %d", volume)
+    self.last_volume = volume
+    self.volume_steps = volume * VOLUME_STEPS
+    self.pending_volumes.clear()
+    
   def adapt_led(self):
-    if self.mode == "VOLUME":
-      colors = COLOR_VOLUME
-    elif self.mode == "TRACKS":
-      colors = COLOR_TRACKS
-    elif self.mode == "OFF":
-      colors = COLOR_OFF
-      
-    if self.mode == "OFF":
-      f = self.led.set
-    else:
-      f = self.led.fade
-    f(colors[0], colors[1], colors[2])
+    colors, function = self.mode_leds[self.mode]
+    function(*colors)
     
 class RotatorThread(threading.Thread): 
   def __init__(self, pi_radio): 
@@ -167,23 +308,100 @@ class RotatorThread(threading.Thread):
     # Store the PiRadio instance that we are gonna report rotation changes back on:
     self.master = pi_radio
     
-    # Rotary encoder for changing volume or tracks
-    self.rotator = gaugette.rotary_encoder.RotaryEncoder(ROT_A_PIN, ROT_B_PIN)
+    # Rotary encoder for changing volume or tracks, both lines pulled up and reporting
+    # their edges straight from the GPIO character device:
+    self.chip = gpiod.Chip(GPIO_CHIP)
+    self.lines = self.chip.get_lines([ROT_A_PIN, ROT_B_PIN])
+    self.lines.request(consumer="piradio", type=gpiod.LINE_REQ_EV_BOTH_EDGES,
+                       flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_UP)
     
-    # Indicator for the thread to finish:
-    self.stop_requested = False
+    # Lines by the file descriptors their edge events are read from:
+    self.lines_by_fd = {line.event_get_fd(): line for line in self.lines.to_list()}
+    
+    # Steps counted since the last detent:
+    self.steps = 0
+    
+    # Current states of pins A and B, kept up to date from the edge events:
+    a, b = self.lines.get_values()
+    self.levels = {ROT_A_PIN: a, ROT_B_PIN: b}
+    
+    # Previous and current states of pins A and B, two bits each:
+    self.previous_ab = (a << 1) | b
+    
+    # Time of the last accepted edge per pin, to filter out contact bounce:
+    self.last_edge_ns = {ROT_A_PIN: 0, ROT_B_PIN: 0}
+    
+    # Pipe to wake the thread up while it is waiting for edges:
+    self.wakeup_read, self.wakeup_write = os.pipe()
+
+  def handle_edge(self, event):
+    # Returns the steps of a detent completed by this edge, 0 otherwise
+    pin = event.source.offset()
+    # Ignore edges following too closely on the same pin, they are contact bounce. The
+    # kernel timestamps the events, so this is independent of how late we read them:
+    now = event.sec * 1000000000 + event.nsec
+    if now - self.last_edge_ns[pin] < ROT_DEBOUNCE_TIME:
+      return 0
+    self.last_edge_ns[pin] = now
+    self.levels[pin] = 1 if event.type == gpiod.LineEvent.RISING_EDGE else 0
+    # Look up the direction of this step from the last two states of the pins:
+    self.previous_ab = ((self.previous_ab << 2) | (self.levels[ROT_A_PIN] << 1) | self.levels[ROT_B_PIN]) & 0x0f
+    self.steps += ENCODER_STATES[self.previous_ab]
+    # Only report full detents:
+    if abs(self.steps) >= STEPS_PER_DETENT:
+      steps, self.steps = self.steps, 0
+      return steps
+    return 0
 
   def stop(self):
-    self.stop_requested = True
+    # Closing our end of the pipe wakes the thread up, as its end then reads as end of file.
+    # This also works when the thread has died already, which closed its end:
+    os.close(self.wakeup_write)
 
   def run(self):
-    while not self.stop_requested:
-      delta = self.rotator.get_delta()
-      if delta != 0:
-        self.master.rotator_changed(delta)
-      time.sleep(0.01)
-    if DEBUG:
-      print("RotatorThread stopped")
+    try:
+      self.read_edges()
+    finally:
+      self.lines.release()
+      self.chip.close()
+      # The other end belongs to stop(), so it never writes to an fd that got reused:
+      os.close(self.wakeup_read)
+    log.debug("RotatorThread stopped")
+
+  def read_edges(self):
+    # Get edges serviced in time even while MPD keeps the CPU busy:
+    try:
+      os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(ROT_PRIORITY))
+    except OSError as e:
+      log.warning("Could not raise the priority of the rotary encoder thread: %s", e)
+    # Single core models like the Pi Zero have no core to pin the thread to. The core is
+    # not checked against the current affinity, as isolcpus takes it out of there:
+    if ROT_CPU < os.cpu_count():
+      try:
+        os.sched_setaffinity(0, {ROT_CPU})
+      except OSError as e:
+        log.warning("Could not pin the rotary encoder thread to CPU %d: %s", ROT_CPU, e)
+    fds = list(self.lines_by_fd) + [self.wakeup_read]
+    while True:
+      # Sleep in the kernel until an edge arrives or we are stopped:
+      ready = select.select(fds, [], [])[0]
+      if self.wakeup_read in ready:
+        break
+      # Take all edges that piled up since, and handle them in the order they happened. A read
+      # returns at most 16 edges per line, so keep reading until none of the lines has any left:
+      events = []
+      while ready:
+        for fd in ready:
+          if fd != self.wakeup_read:
+            events.extend(self.lines_by_fd[fd].event_read_multiple())
+        ready = select.select(list(self.lines_by_fd), [], [], 0)[0]
+      events.sort(key=lambda event: (event.sec, event.nsec))
+      delta = 0
+      for event in events:
+        delta += self.handle_edge(event)
+      # Report the whole batch at once:
+      if delta:
+        self.master.post_event("ROTATOR", delta)
       
 class ButtonThread(threading.Thread): 
   def __init__(self, pi_radio): 
@@ -192,56 +410,279 @@ class ButtonThread(threading.Thread):
     # Store the PiRadio instance that we are gonna report button pushes back on:
     self.master = pi_radio
     
-    # Push button to change between modes and to stop and start playback
-    self.switch = gaugette.switch.Switch(BUTTON_PIN)
+    # Push button to change between modes and to stop and start playback, pulled up:
+    GPIO.setup(BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    
+    # Last known state of the button:
+    self.pressed = False
+    
+    # Used to indicate that a long-press should not be additionally 
+    # considered a button release:
+    self.long_press_registered = False
+    
+    # Timer that fires the long-press event while the button is held down:
+    self.long_press_timer = None
+    
+    # Point in time (of the monotonic clock) at which the current press becomes a long press:
+    self.long_press_at = 0
+    
+    # Timer that reads the pin once it has stopped bouncing after an edge:
+    self.settle_timer = None
+    
+    # Guards the state above against the edge callback and the timers racing each other:
+    self.lock = threading.Lock()
     
     # Indicator for the thread to finish:
-    self.stop_requested = False
+    self._stop_event = threading.Event()
+    
+    # Let the GPIO library call back on every press and release instead of polling:
+    GPIO.add_event_detect(BUTTON_PIN, GPIO.BOTH, callback=self._on_edge, bouncetime=BUTTON_BOUNCE_TIME)
+
+  def _on_edge(self, channel):
+    # The pin may still be bouncing, and the GPIO library drops the edges following within
+    # the bounce time, so only read the pin once it has settled:
+    with self.lock:
+      if self.settle_timer is None and not self._stop_event.is_set():
+        self.settle_timer = threading.Timer(BUTTON_BOUNCE_TIME / 1000.0, self._on_settled)
+        self.settle_timer.start()
+
+  def _on_settled(self):
+    # Edges from now on need another read of the pin:
+    with self.lock:
+      self.settle_timer = None
+    # The pin is pulled up, so it reads low while the button is pressed down:
+    pressed = GPIO.input(BUTTON_PIN) == GPIO.LOW
+    with self.lock:
+      if pressed == self.pressed or self._stop_event.is_set():
+        return
+      self.pressed = pressed
+      if pressed:
+        # The button has just been pressed down, arm the long-press timer:
+        self.long_press_registered = False
+        self.long_press_at = time.monotonic() + LONG_PRESS_DURATION / 1000.0
+        self.long_press_timer = threading.Timer(LONG_PRESS_DURATION / 1000.0, self._on_long_press)
+        self.long_press_timer.start()
+        return
+      # The button has just been released:
+      self.long_press_timer.cancel()
+      # Only process this release if it has not already been processed as a long press:
+      released = not self.long_press_registered
+    if released:
+      self.master.post_event("RELEASED")
+
+  def _on_long_press(self):
+    with self.lock:
+      # The button may have been released while the timer was about to fire, or this
+      # may be the timer of an earlier press that could not be cancelled in time:
+      if not self.pressed or time.monotonic() < self.long_press_at:
+        return
+      self.long_press_registered = True
+    self.master.post_event("LONG_PRESS")
 
   def stop(self):
-    self.stop_requested = True
+    self._stop_event.set()
+    GPIO.remove_event_detect(BUTTON_PIN)
+    with self.lock:
+      for timer in (self.settle_timer, self.long_press_timer):
+        if timer is not None:
+          timer.cancel()
 
   def run(self):
-    last_state = False
-    # Used to indicate that a long-press should not be additionally 
-    # considered a button release:
-    long_press_registered = False
-    time_of_press = -1
-    while not self.stop_requested:
-      sw_state = self.switch.get_state()
-      if sw_state != last_state:
-        # Check if the button has just been released:
-        if sw_state == 0:
-          time_of_press = -1
-          # Only process this release if it has not already been processed as a long press:
-          if not long_press_registered:
-            self.master.button_released()
-          else:
-            long_press_registered = False
-        else:
-          # If the button has just been pressed down, start counting the time it has been pressed:
-          time_of_press = time.time()
-        last_state = sw_state
-      elif sw_state == 1:
-        if DEBUG and time_of_press > 0:
-          print ((time.time() - time_of_press)) * 1000
-        # Check if the button has been pressed long enough to trigger a long-press event:
-        if (time_of_press > 0) and ((time.time() - time_of_press) * 1000 > LONG_PRESS_DURATION):
+    # Nothing to do here, the edge callbacks do all the work until we are stopped:
+    self._stop_event.wait()
+    log.debug("ButtonThread stopped")
+      
+class MpdProxy:
+  def __init__(self, host, port):
+    self._host, self._port = host, port
+    
+    # MPD client connection, opened on first use:
+    self._client = None
+    
+    # Serializes the commands sent from the different threads:
+    self._lock = threading.Lock()
+
+  def _connect(self):
+    client = mpd.MPDClient()
+    client.timeout = 10
+    client.idletimeout = None
+    client.connect(self._host, self._port)
+    # Only keep connections that succeeded, so the next call tries again otherwise:
+    self._client = client
+
+  def _disconnect(self):
+    try:
+      self._client.disconnect()
+    except (mpd.ConnectionError, OSError):
+      pass
+    self._client = None
+
+  def call(self, method, *args):
+    with self._lock:
+      if self._client is None:
+        self._connect()
+      try:
+        return getattr(self._client, method)(*args)
+      except socket.timeout:
+        # MPD may well have executed the command, so retrying could e.g. skip two tracks.
+        # The late response would confuse the next command though, so start over:
+        self._disconnect()
+        raise
+      except (mpd.ConnectionError, OSError):
+        # MPD may have been restarted, so retry once on a fresh connection:
+        log.warning("Lost connection to MPD, reconnecting")
+        self._disconnect()
+        self._connect()
+        return getattr(self._client, method)(*args)
+
+  def setvol(self, volume):
+    return self.call("setvol", volume)
+
+  def next(self):
+    return self.call("next")
+
+  def previous(self):
+    return self.call("previous")
+
+  def play(self):
+    return self.call("play")
+
+  def stop(self):
+    return self.call("stop")
+    
+class DispatchThread(threading.Thread):
+  def __init__(self, pi_radio):
+    threading.Thread.__init__(self)
+    
+    # Store the PiRadio instance whose input events we are gonna handle:
+    self.master = pi_radio
+
+  def stop(self):
+    # Wake the thread up with an empty event once all pending events are handled. Only wait
+    # for room in the queue while the thread is still around to make some:
+    while self.is_alive():
+      try:
+        self.master.events.put(None, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def run(self):
+    # Event taken from the queue while coalescing, but not handled yet:
+    pending = collections.deque()
+    while True:
+      event = pending.popleft() if pending else self.master.events.get()
+      if event is None:
+        break
+      kind, value = event
+      if kind == "ROTATOR":
+        # Sum up the rotation that piled up in the meantime, so it results in a single MPD command:
+        while True:
+          try:
+            event = self.master.events.get_nowait()
+          except queue.Empty:
+            break
+          if event is None or event[0] != "ROTATOR":
+            pending.append(event)
+            break
+          value += event[1]
+      try:
+        if kind == "ROTATOR":
+          self.master.rotator_changed(value)
+        elif kind == "RELEASED":
+          self.master.button_released()
+        elif kind == "LONG_PRESS":
           self.master.button_long_press()
-          long_press_registered = True
-          time_of_press = -1
-      time.sleep(0.01)
-    if DEBUG:
-      print("ButtonThread stopped")
+        elif kind == "MIXER":
+          self.master.volume_changed(value)
+      except Exception:
+        # Keep handling events, MPD may well be back for the next one:
+        log.exception("Failed to handle %s event", kind)
+    log.debug("DispatchThread stopped")
+      
+class MpdIdleThread(threading.Thread):
+  def __init__(self, pi_radio):
+    threading.Thread.__init__(self)
+    
+    # Store the PiRadio instance that we are gonna keep in sync with MPD:
+    self.master = pi_radio
+    
+    # Separate MPD client connection that waits for changes in the player and the mixer,
+    # the playback connection cannot be used for that while it is idling. Opened by the thread:
+    self.client = None
+    
+    # Pipe to wake the thread up while it is waiting for MPD:
+    self.wakeup_read, self.wakeup_write = os.pipe()
+
+  def connect(self):
+    client = mpd.MPDClient()
+    client.timeout = 10
+    client.idletimeout = None
+    client.connect(MPD_HOST, MPD_PORT)
+    self.client = client
+    # Changes may have been missed while not connected:
+    self.post_volume()
+
+  def disconnect(self):
+    try:
+      self.client.disconnect()
+    except (mpd.ConnectionError, OSError):
+      pass
+    self.client = None
+
+  def post_volume(self):
+    # MPD leaves the volume out when there is no mixer:
+    self.master.post_event("MIXER", int(self.client.status().get("volume", -1)))
+
+  def stop(self):
+    # Closing our end of the pipe wakes the thread up, as its end then reads as end of file.
+    # This also works when the thread has died already, which closed its end:
+    os.close(self.wakeup_write)
+
+  def idle(self):
+    # Waits for and handles changes until the thread is stopped:
+    while True:
+      self.client.send_idle("player", "mixer")
+      ready = select.select([self.client, self.wakeup_read], [], [])[0]
+      if self.wakeup_read in ready:
+        # Leave the idle mode gracefully before disconnecting:
+        self.client.noidle()
+        return
+      for subsystem in self.client.fetch_idle():
+        if subsystem == "mixer":
+          self.post_volume()
+        elif subsystem == "player" and log.isEnabledFor(logging.DEBUG):
+          log.debug("Player state: %s", self.client.status()["state"])
+
+  def run(self):
+    try:
+      while True:
+        try:
+          if self.client is None:
+            self.connect()
+          self.idle()
+          break
+        except (mpd.MPDError, OSError) as e:
+          log.warning("Connection to MPD failed while waiting for changes (%s), reconnecting", e)
+          if self.client is not None:
+            self.disconnect()
+          # Give MPD some time to come back, but still react to being stopped meanwhile:
+          if select.select([self.wakeup_read], [], [], MPD_RECONNECT_DELAY)[0]:
+            break
+    finally:
+      if self.client is not None:
+        self.disconnect()
+      # The other end belongs to stop(), so it never writes to an fd that got reused:
+      os.close(self.wakeup_read)
+    log.debug("MpdIdleThread stopped")
       
 if __name__ == "__main__":
   if len(sys.argv) == 2 and sys.argv[1].lower() == "debug":
     DEBUG = True
-  if DEBUG:
-    print("Starting PiRadio...")
+  logging.basicConfig(level=logging.DEBUG if DEBUG else logging.WARNING)
+  log.debug("Starting PiRadio...")
   PiRadio()
-  if DEBUG:
-    print("PiRadio finished")
+  log.debug("PiRadio finished")
   
   
   
\ No newline at end of file